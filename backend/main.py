@@ -5,6 +5,7 @@ import mcp.types as types
 from mcp.server.lowlevel import Server
 from mcp.server.streamable_http_manager import StreamableHTTPSessionManager
 import contextlib
+import asyncio
 from starlette.routing import Mount
 from starlette.types import Scope, Receive, Send
 
@@ -16,18 +17,53 @@ except ImportError:
     ZImagePipeline = None
 
 try:
-    from optimum.quanto import quantize, freeze, qfloat8
+    from optimum.quanto import quantize, freeze, qfloat8, quantization_map, requantize
 except ImportError:
     print("optimum-quanto not installed. Quantization features will be unavailable.")
     quantize = None
 
+try:
+    from torchao.quantization import quantize_, float8_dynamic_activation_float8_weight, PerRow
+except ImportError:
+    print("torchao not installed. TorchAO FP8 quantization will be unavailable.")
+    quantize_ = None
+
+try:
+    import modelopt.torch.opt as mto
+    import modelopt.torch.quantization as mtq
+except ImportError:
+    mto = None
+    mtq = None
+
 import torch
+from torch.nn.attention import sdpa_kernel, SDPBackend
+from torchvision.io import encode_png
+from torchvision.transforms.functional import to_pil_image
+from safetensors.torch import load_file, save_file
 import io
-import base64
+try:
+    # SIMD accelerated base64, same API as the stdlib module
+    import pybase64 as base64
+except ImportError:
+    import base64
 import uuid
 from datetime import datetime
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 import os
+import hashlib
+import importlib.metadata
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+
+# Allow TF32 for any remaining fp32 matmuls
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
+# Let cuDNN pick the fastest conv algorithms for the VAE; shapes are fixed per resolution
+torch.backends.cudnn.benchmark = True
+
+# Common resolutions warmed up at startup so cuDNN autotuning happens before the first request
+WARMUP_SIZES = [(512, 512), (768, 768), (1024, 1024), (1024, 1536), (1536, 1024)]
 
 # MCP Server Init
 mcp_server = Server("z-image-turbo")
@@ -36,7 +72,27 @@ session_manager = StreamableHTTPSessionManager(mcp_server, stateless=True)
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI):
     async with session_manager.run():
-        yield
+        # Load the model and run one warmup step per common resolution before serving, so the
+        # first request doesn't pay for loading, quantization, compile or cuDNN autotuning
+        try:
+            pipeline = await run_in_threadpool(get_pipeline)
+        except Exception as e:
+            pipeline = None
+            print(f"Error preloading model: {e}. Model will load on first generation.")
+
+        # Nothing to autotune on CPU, and full generations there would block startup for ages
+        if pipeline is not None and pipeline._zit_device.type == "cuda":
+            for height, width in WARMUP_SIZES:
+                try:
+                    await run_in_threadpool(generate_image_core, "warmup", height, width, 1, 0.0, 0, "png", False)
+                except Exception as e:
+                    print(f"Error warming up at {width}x{height}: {e}")
+            torch.cuda.empty_cache()
+        batcher.start()
+        try:
+            yield
+        finally:
+            await batcher.stop()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -53,59 +109,241 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-import json
+import orjson
+from dataclasses import dataclass, asdict, fields, replace
 
 CONFIG_FILE = "config.json"
 
+@dataclass(slots=True, frozen=True)
+class ModelConfig:
+    cache_dir: str = ""
+    model_id: str = "Tongyi-MAI/Z-Image-Turbo"
+    gpu_device: int = 1
+    cpu_offload: bool = True
+    fp8_quantization: bool = True
+    quant_backend: str = "torchao_fp8dqrow"
+    modelopt_checkpoint: str = ""
+    compile: bool = False
+    save_to_disk: bool = False
+    max_batch_size: int = 8
+
 def load_config():
     if os.path.exists(CONFIG_FILE):
         try:
-            with open(CONFIG_FILE, "r") as f:
-                return json.load(f)
+            with open(CONFIG_FILE, "rb") as f:
+                data = orjson.loads(f.read())
+            # Older config files predate CPU offload; keep it off for them
+            data.setdefault("cpu_offload", False)
+            known = {field.name for field in fields(ModelConfig)}
+            return ModelConfig(**{k: v for k, v in data.items() if k in known})
         except Exception as e:
             print(f"Error loading config: {e}")
-    return {
-        "cache_dir": "",
-        "model_id": "Tongyi-MAI/Z-Image-Turbo",
-        "gpu_device": 1,
-        "cpu_offload": True,
-        "fp8_quantization": True
-    }
+    return ModelConfig()
 
 def save_config(config):
+    # Write to a temp file and swap it in, so a crash mid-write can't leave a truncated config
+    tmp = CONFIG_FILE + ".tmp"
     try:
-        with open(CONFIG_FILE, "w") as f:
-            json.dump(config, f, indent=4)
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps(asdict(config), option=orjson.OPT_INDENT_2))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, CONFIG_FILE)
     except Exception as e:
         print(f"Error saving config: {e}")
 
 import psutil
 import time
 
-# Global configuration
+# Global configuration. Frozen; changes swap in a new ModelConfig.
 model_config = load_config()
-if "cpu_offload" not in model_config:
-    model_config["cpu_offload"] = False
-if "fp8_quantization" not in model_config:
-    model_config["fp8_quantization"] = True
+
+QUANT_BACKENDS = ("torchao_fp8dqrow", "modelopt_fp8", "quanto")
+
+# Modules kept in BF16 when using ModelOpt FP8 (small, precision sensitive)
+MODELOPT_BF16_PATTERNS = ["*norm*", "*embed*"]
 
 # Global variable for the pipeline
 pipe = None
 
+# LRU cache of text encoder outputs, keyed by prompt hash. Re-rolling a prompt with a new
+# seed or size then skips the text encoder entirely.
+PROMPT_EMBEDS_CACHE_SIZE = 128
+prompt_embeds_cache = OrderedDict()
+
+# Background writer so saving images to disk doesn't block the response
+disk_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-writer")
+
+IMAGE_FORMATS = {
+    "png": "image/png",
+    "webp": "image/webp",
+}
+
+def fp8_cache_paths(name, module):
+    """Paths of the cached quanto FP8 weights and quantization map for a pipeline component."""
+    # The module config carries the resolved snapshot path, so a new model revision or a new
+    # quanto release gets a fresh cache entry instead of loading stale weights
+    config = module.config.to_dict() if hasattr(module.config, "to_dict") else dict(module.config)
+    config_hash = hashlib.sha256(orjson.dumps(config, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS, default=str)).hexdigest()
+    # The load dtype (bf16 on CUDA, float32 on CPU) determines the dtype of the quantization scales
+    key_source = f"{model_config.model_id}-fp8-{module.dtype}-{torch.__version__}-{importlib.metadata.version('optimum-quanto')}-{config_hash}"
+    key = hashlib.sha256(key_source.encode()).hexdigest()[:16]
+    cache_dir = os.path.join(model_config.cache_dir or ".", "fp8_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    return (
+        os.path.join(cache_dir, f"{name}_{key}.safetensors"),
+        os.path.join(cache_dir, f"{name}_{key}_qmap.json"),
+    )
+
+def torchao_fp8_supported(device):
+    """TorchAO's FP8 dynamic activation kernels need SM 8.9+. ROCm consumer GPUs don't have them."""
+    if quantize_ is None or "cuda" not in device:
+        return False
+    if torch.version.hip is not None:
+        return False
+    return torch.cuda.get_device_capability(torch.device(device)) >= (8, 9)
+
+def quantize_pipeline(pipeline, backend, device):
+    """Quantize the transformer and text encoder to FP8. The VAE stays in BF16.
+
+    Returns the backend that was actually applied, or None if the model was left unquantized.
+    """
+    if backend not in QUANT_BACKENDS:
+        print(f"Warning: Unknown quant_backend '{backend}'. Falling back to quanto.")
+        backend = "quanto"
+
+    if backend == "torchao_fp8dqrow" and not torchao_fp8_supported(device):
+        print("TorchAO FP8 requires torchao and an NVIDIA GPU with compute capability 8.9+ (Ada/Hopper). Falling back to quanto.")
+        backend = "quanto"
+
+    if backend == "torchao_fp8dqrow":
+        # fp8dqrow keeps activations in FP8 as well, so the matmuls run on FP8 tensor cores.
+        # The weights have to be on the GPU before quantize_ is applied.
+        print("Quantizing transformer and text_encoder to FP8 with TorchAO (fp8dqrow)...")
+        pipeline.transformer.to(device)
+        quantize_(pipeline.transformer, float8_dynamic_activation_float8_weight(granularity=PerRow()))
+        if getattr(pipeline, "text_encoder", None) is not None:
+            pipeline.text_encoder.to(device)
+            quantize_(pipeline.text_encoder, float8_dynamic_activation_float8_weight(granularity=PerRow()))
+        return backend
+    elif backend == "modelopt_fp8":
+        checkpoint = model_config.modelopt_checkpoint
+        if mto is None:
+            print("nvidia-modelopt not installed. Skipping FP8 quantization.")
+            return None
+        if not checkpoint or not os.path.exists(checkpoint):
+            print("ModelOpt FP8 needs a pre-converted checkpoint (modelopt_checkpoint). Skipping FP8 quantization.")
+            return None
+        print(f"Restoring ModelOpt FP8 transformer from {checkpoint}...")
+        mto.restore(pipeline.transformer, checkpoint)
+        for pattern in MODELOPT_BF16_PATTERNS:
+            mtq.disable_quantizer(pipeline.transformer, pattern)
+        return backend
+    else:
+        if quantize is None:
+            print("optimum-quanto not installed. Skipping FP8 quantization.")
+            return None
+        for name in ("transformer", "text_encoder"):
+            module = getattr(pipeline, name, None)
+            if module is None:
+                continue
+            weights_path, qmap_path = fp8_cache_paths(name, module)
+            if os.path.exists(weights_path) and os.path.exists(qmap_path):
+                print(f"Loading cached FP8 {name} from {weights_path}...")
+                with open(qmap_path, "rb") as f:
+                    qmap = orjson.loads(f.read())
+                requantize(module, load_file(weights_path), qmap)
+                continue
+
+            print(f"Quantizing {name} to FP8 with quanto...")
+            quantize(module, weights=qfloat8)
+            freeze(module)
+            try:
+                save_file(module.state_dict(), weights_path)
+                with open(qmap_path, "wb") as f:
+                    f.write(orjson.dumps(quantization_map(module)))
+                print(f"Cached FP8 {name} to {weights_path}")
+            except Exception as e:
+                print(f"Error caching FP8 {name}: {e}")
+        return backend
+
+# Room for activations and the VAE decode on top of the weights
+ACTIVATION_HEADROOM_BYTES = 2 * 1024**3
+
+def pipeline_fits_on_gpu(pipeline, gpu_id):
+    """Whether the whole pipeline fits in free VRAM, in which case CPU offload only costs latency."""
+    required_bytes = ACTIVATION_HEADROOM_BYTES
+    for name in ("transformer", "text_encoder", "vae"):
+        module = getattr(pipeline, name, None)
+        if module is None:
+            continue
+        # state_dict splits quanto weights into their FP8 _data and _scale tensors, so this measures
+        # real storage; a QTensor's own element_size() reports the bf16 scale dtype
+        for t in module.state_dict().values():
+            # Weights already moved to the GPU (e.g. by TorchAO quantization) are counted in free memory
+            if t.device.type != "cuda":
+                required_bytes += t.nbytes
+
+    free, total = torch.cuda.mem_get_info(gpu_id)
+    print(f"Model needs {required_bytes / 1024**3:.1f} GB, {free / 1024**3:.1f} GB of {total / 1024**3:.1f} GB free on GPU {gpu_id}")
+    return required_bytes * 1.2 < free
+
+def inference_context(pipeline):
+    """The autograd and attention context every pipeline call runs under."""
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.inference_mode())
+    # Try flash first, then memory efficient attention, with math last as a fallback for inputs
+    # or builds (e.g. ROCm on Windows) those kernels don't support
+    if pipeline._zit_device.type == "cuda":
+        stack.enter_context(sdpa_kernel(
+            [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH],
+            set_priority=True,
+        ))
+    return stack
+
+def compile_pipeline(pipeline, quant_backend, offloaded):
+    """Compile the transformer and VAE decoder, then run a warmup so the first request doesn't pay for it."""
+    if quant_backend not in (None, "torchao_fp8dqrow"):
+        # Only BF16 and TorchAO fp8dqrow compose cleanly with torch.compile
+        print(f"torch.compile is not supported with quant_backend '{quant_backend}'. Skipping compile.")
+        return
+    if offloaded:
+        # accelerate's device-moving hooks break fullgraph compilation
+        print("torch.compile is not supported with CPU Offload. Skipping compile.")
+        return
+
+    print("Compiling transformer and VAE decoder with torch.compile...")
+    pipeline.transformer = torch.compile(pipeline.transformer, mode="max-autotune", fullgraph=True, dynamic=False)
+    pipeline.vae.decode = torch.compile(pipeline.vae.decode, mode="reduce-overhead")
+
+    # Shapes don't depend on the step count, so one step is enough to compile the graph requests use
+    print("Warming up compiled pipeline at 1024x1024...")
+    with inference_context(pipeline):
+        pipeline(
+            prompt="warmup",
+            height=1024,
+            width=1024,
+            num_inference_steps=1,
+            guidance_scale=0.0,
+            output_type="pt",
+        )
+
 def get_pipeline():
-    global pipe
+    global pipe, model_config
     if pipe is None:
+        # Embeddings from a previous model are not valid for the new one
+        prompt_embeds_cache.clear()
         if ZImagePipeline is None:
             raise HTTPException(status_code=500, detail="ZImagePipeline class not available. Install diffusers from source.")
             
-        print(f"Loading model {model_config['model_id']}...")
+        print(f"Loading model {model_config.model_id}...")
         
-        if model_config['cache_dir']:
-            print(f"Using cache directory: {model_config['cache_dir']}")
+        if model_config.cache_dir:
+            print(f"Using cache directory: {model_config.cache_dir}")
 
         try:
             # Check for CUDA
-            gpu_id = model_config.get("gpu_device", 0)
+            gpu_id = model_config.gpu_device
             if torch.cuda.is_available():
                 device_count = torch.cuda.device_count()
                 available_gpus = [torch.cuda.get_device_name(i) for i in range(device_count)]
@@ -115,7 +353,7 @@ def get_pipeline():
                     print(f"Available GPUs: {available_gpus}")
                     print("Falling back to GPU 0.")
                     gpu_id = 0
-                    model_config["gpu_device"] = 0
+                    model_config = replace(model_config, gpu_device=0)
                 
                 device = f"cuda:{gpu_id}"
             else:
@@ -124,44 +362,47 @@ def get_pipeline():
             
             dtype = torch.bfloat16 if "cuda" in device else torch.float32
             
-            should_quantize = model_config.get("fp8_quantization", False)
-            if should_quantize and quantize is not None:
-                print("Quantization enabled. Loading original model and quantizing...")
-                pipe = ZImagePipeline.from_pretrained(
-                    model_config['model_id'],
-                    torch_dtype=dtype,
-                    low_cpu_mem_usage=False,
-                    cache_dir=model_config['cache_dir']
-                )
-                
-                print("Quantizing transformer, text_encoder and VAE to FP8...")
-                quantize(pipe.transformer, weights=qfloat8)
-                freeze(pipe.transformer)
-                
-                if hasattr(pipe, "text_encoder") and pipe.text_encoder is not None:
-                    quantize(pipe.text_encoder, weights=qfloat8)
-                    freeze(pipe.text_encoder)
-
-                if hasattr(pipe, "vae") and pipe.vae is not None:
-                    quantize(pipe.vae, weights=qfloat8)
-                    freeze(pipe.vae)
-            else:
-                pipe = ZImagePipeline.from_pretrained(
-                    model_config['model_id'],
-                    torch_dtype=dtype,
-                    low_cpu_mem_usage=False,
-                    cache_dir=model_config['cache_dir']
-                )
-            
-            if model_config.get("cpu_offload", False) and "cuda" in device:
+            pipe = ZImagePipeline.from_pretrained(
+                model_config.model_id,
+                torch_dtype=dtype,
+                # Stream mmap'd safetensors weights instead of materializing a full state_dict copy in RAM
+                low_cpu_mem_usage=True,
+                use_safetensors=True,
+                cache_dir=model_config.cache_dir
+            )
+
+            quant_backend = None
+            if model_config.fp8_quantization:
+                quant_backend = quantize_pipeline(pipe, model_config.quant_backend, device)
+
+            offloaded = False
+            if model_config.cpu_offload and "cuda" in device and pipeline_fits_on_gpu(pipe, gpu_id):
+                print("Model fits in free VRAM. Skipping CPU Offload and loading fully on GPU.")
+                pipe.to(device)
+            elif model_config.cpu_offload and "cuda" in device:
                 print("Enabling CPU Offload")
                 pipe.enable_model_cpu_offload(gpu_id=gpu_id)
+                offloaded = True
             else:
                 pipe.to(device)
-                
+
+            if "cuda" in device:
+                # The VAE decoder is a conv stack, which is faster in NHWC on Ampere+
+                pipe.vae.to(memory_format=torch.channels_last)
+
+            # Resolved once here so requests don't have to query CUDA again
+            pipe._zit_device = torch.device(device)
+            pipe._zit_generators = []
+            pipe._zit_offloaded = offloaded
+
+            if model_config.compile:
+                compile_pipeline(pipe, quant_backend, offloaded)
+
             print(f"Model loaded on {device}")
         except Exception as e:
             print(f"Error loading model: {e}")
+            # Don't leave a half-initialized pipeline behind; retry the load on the next request
+            pipe = None
             raise e
     return pipe
 
@@ -173,16 +414,25 @@ class SettingsRequest(BaseModel):
 
 @app.post("/settings/model-path")
 async def set_model_path(req: SettingsRequest):
-    global pipe
+    global pipe, model_config
     try:
-        if req.cache_dir and not os.path.exists(req.cache_dir):
+        new_config = replace(
+            model_config,
+            cache_dir=req.cache_dir,
+            cpu_offload=req.cpu_offload,
+            gpu_device=req.gpu_device,
+            fp8_quantization=req.fp8_quantization,
+        )
+        # Every field here affects how the model is loaded, so only reload when one of them changed
+        if new_config == model_config:
+            await run_in_threadpool(save_config, model_config)
+            return {"status": "success", "message": "Settings saved. No changes, model kept loaded."}
+
+        if req.cache_dir != model_config.cache_dir and req.cache_dir and not os.path.exists(req.cache_dir):
             os.makedirs(req.cache_dir, exist_ok=True)
-        
-        model_config["cache_dir"] = req.cache_dir
-        model_config["cpu_offload"] = req.cpu_offload
-        model_config["gpu_device"] = req.gpu_device
-        model_config["fp8_quantization"] = req.fp8_quantization
-        save_config(model_config)
+
+        model_config = new_config
+        await run_in_threadpool(save_config, model_config)
         # Force reload of the pipeline
         pipe = None
         return {"status": "success", "message": "Settings saved. Model will reload on next generation."}
@@ -202,7 +452,7 @@ def get_system_info():
 
 @app.get("/settings")
 async def get_settings():
-    return model_config
+    return asdict(model_config)
 
 class GenerateRequest(BaseModel):
     prompt: str
@@ -212,59 +462,249 @@ class GenerateRequest(BaseModel):
     guidance_scale: float = 0.0
     seed: int = -1
 
-def generate_image_core(prompt: str, height: int = 1024, width: int = 1024, steps: int = 8, guidance_scale: float = 0.0, seed: int = -1):
-    # Validate dimensions
+def write_file(filepath: str, data: memoryview):
+    # Runs on the background writer, so nothing else would see the error
+    try:
+        with open(filepath, "wb") as f:
+            f.write(data)
+        print(f"Image saved to {filepath}")
+    except Exception as e:
+        print(f"Error saving image to {filepath}: {e}")
+
+def encode_image(image: torch.Tensor, image_format: str = "png") -> memoryview:
+    """Encode a CHW uint8 CPU tensor."""
+    if image_format == "png":
+        # libpng in C straight from the tensor; zlib level 1 is several times faster than the default level 6
+        return encode_png(image, compression_level=1).numpy().data
+
+    # torchvision has no WebP encoder, so go through PIL
+    buffered = io.BytesIO()
+    to_pil_image(image).save(buffered, format="WEBP", lossless=True)
+    # A view of the buffer rather than a getvalue() copy. The view keeps the BytesIO alive
+    # and the backing memory is released once the last view is dropped.
+    return buffered.getbuffer()
+
+def validate_request(prompt: str, height: int, width: int, image_format: str):
+    if not isinstance(prompt, str):
+        raise ValueError("Prompt must be a string.")
     if height % 16 != 0 or width % 16 != 0:
         raise ValueError("Height and Width must be divisible by 16.")
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format: {image_format}. Use one of {list(IMAGE_FORMATS)}.")
+
+def to_base64(image_bytes: memoryview) -> str:
+    return base64.b64encode(image_bytes).decode("ascii")
+
+def encode_prompts(pipeline, prompts: list[str]):
+    """Text encoder outputs for the prompts, served from prompt_embeds_cache where possible."""
+    embeds = []
+    as_list = False
+    for prompt in prompts:
+        key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        if key in prompt_embeds_cache:
+            prompt_embeds_cache.move_to_end(key)
+        else:
+            prompt_embeds, _ = pipeline.encode_prompt(
+                prompt=prompt,
+                device=pipeline._execution_device,
+                do_classifier_free_guidance=False,
+            )
+            # Z-Image returns one variable length tensor per prompt; other pipelines return a batched tensor
+            prompt_embeds_cache[key] = (prompt_embeds[0], isinstance(prompt_embeds, list))
+            if len(prompt_embeds_cache) > PROMPT_EMBEDS_CACHE_SIZE:
+                prompt_embeds_cache.popitem(last=False)
+        embed, as_list = prompt_embeds_cache[key]
+        embeds.append(embed)
+    return embeds if as_list else torch.stack(embeds)
+
+def generate_images_core(requests: list[dict], save: bool = True) -> list[tuple[memoryview, str]]:
+    """Run one pipeline call for a batch of requests sharing height, width, steps and guidance_scale."""
+    first = requests[0]
+    for req in requests:
+        validate_request(req["prompt"], req["height"], req["width"], req["image_format"])
 
     pipeline = get_pipeline()
-    
-    gpu_id = model_config.get("gpu_device", 0)
-    if torch.cuda.is_available():
-        if gpu_id < 0 or gpu_id >= torch.cuda.device_count():
-            gpu_id = 0
-        device = f"cuda:{gpu_id}"
-    else:
-        device = "cpu"
 
-    generator = None
-    if seed != -1:
-        generator = torch.Generator(device).manual_seed(seed)
+    # CPU generators avoid allocating cuRAND state per request and give the same image for a seed on any GPU.
+    # They are created once and reseeded; GPU work is serialized so they are never shared between calls.
+    # Random seeds are drawn here too so diffusers can skip its own seeding path.
+    generators = pipeline._zit_generators
+    while len(generators) < len(requests):
+        generators.append(torch.Generator("cpu"))
+    generator = []
+    for req, g in zip(requests, generators):
+        seed = req["seed"] if req["seed"] != -1 else int.from_bytes(os.urandom(8), "big")
+        generator.append(g.manual_seed(seed))
     
     # Run inference
-    print(f"Generating with prompt: {prompt}")
-    
-    image = pipeline(
-        prompt=prompt,
-        height=height,
-        width=width,
-        num_inference_steps=steps,
-        guidance_scale=guidance_scale,
-        generator=generator,
-    ).images[0]
+    for req in requests:
+        print(f"Generating with prompt: {req['prompt']}")
     
-    # Save to output folder
+    with inference_context(pipeline):
+        if first["guidance_scale"] <= 1.0:
+            prompt_kwargs = {"prompt_embeds": encode_prompts(pipeline, [req["prompt"] for req in requests])}
+        else:
+            # CFG also needs negative embeddings; let the pipeline encode those itself
+            prompt_kwargs = {"prompt": [req["prompt"] for req in requests]}
+
+        images = pipeline(
+            **prompt_kwargs,
+            height=first["height"],
+            width=first["width"],
+            num_inference_steps=first["steps"],
+            guidance_scale=first["guidance_scale"],
+            generator=generator,
+            # Keep the decoded images as a tensor; skips diffusers' numpy / PIL conversion
+            output_type="pt",
+        ).images
+
+        # One device-to-host copy for the whole batch
+        images = (images.clamp(0, 1) * 255).round().to(torch.uint8).cpu()
+
+    results = []
     output_dir = "output"
-    os.makedirs(output_dir, exist_ok=True)
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_id = str(uuid.uuid4())[:8]
-    filename = f"{timestamp}_{unique_id}.png"
-    filepath = os.path.join(output_dir, filename)
-    image.save(filepath)
-    print(f"Image saved to {filepath}")
-
-    # Convert to base64
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    save_to_disk = save and model_config.save_to_disk
+    if save_to_disk:
+        os.makedirs(output_dir, exist_ok=True)
+    for req, image in zip(requests, images):
+        # Encode once, then reuse the bytes for the file and the response
+        image_bytes = encode_image(image, req["image_format"])
+
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        unique_id = str(uuid.uuid4())[:8]
+        filename = f"{timestamp}_{unique_id}.{req['image_format']}"
+        if save_to_disk:
+            # Written on a background thread so it overlaps with the next generation
+            disk_writer.submit(write_file, os.path.join(output_dir, filename), image_bytes)
+
+        results.append((image_bytes, filename))
     
-    return img_str
+    return results
+
+def generate_image_core(prompt: str, height: int = 1024, width: int = 1024, steps: int = 8, guidance_scale: float = 0.0, seed: int = -1, image_format: str = "png", save: bool = True):
+    return generate_images_core([{
+        "prompt": prompt,
+        "height": height,
+        "width": width,
+        "steps": steps,
+        "guidance_scale": guidance_scale,
+        "seed": seed,
+        "image_format": image_format,
+    }], save)[0]
+
+def batch_key(params: dict):
+    return (params["height"], params["width"], params["steps"], params["guidance_scale"])
+
+class BatchingServer:
+    """Groups concurrent requests with the same shape into a single batched pipeline call."""
+
+    def __init__(self, max_latency_ms: int = 50):
+        self.max_latency_ms = max_latency_ms
+        self.queue = asyncio.Queue()
+        # Items pulled off the queue that didn't match the batch being collected
+        self.pending = []
+        self.worker = None
+
+    def batch_limit(self):
+        # With CPU offload there is no VRAM to spare for batched activations
+        if pipe is not None and pipe._zit_offloaded:
+            return 1
+        return max(1, model_config.max_batch_size)
+
+    def start(self):
+        self.worker = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.worker
+            self.worker = None
+
+    async def submit(self, prompt: str, height: int = 1024, width: int = 1024, steps: int = 8, guidance_scale: float = 0.0, seed: int = -1, image_format: str = "png"):
+        # Validate up front so one bad request can't fail the whole batch
+        validate_request(prompt, height, width, image_format)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((future, {
+            "prompt": prompt,
+            "height": height,
+            "width": width,
+            "steps": steps,
+            "guidance_scale": guidance_scale,
+            "seed": seed,
+            "image_format": image_format,
+        }))
+        return await future
+
+    async def collect_batch(self):
+        first = self.pending.pop(0) if self.pending else await self.queue.get()
+        key = batch_key(first[1])
+        max_batch_size = self.batch_limit()
+        batch = [first]
+
+        leftover = []
+        for item in self.pending:
+            if len(batch) < max_batch_size and batch_key(item[1]) == key:
+                batch.append(item)
+            else:
+                leftover.append(item)
+        self.pending = leftover
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_latency_ms / 1000
+        while len(batch) < max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if batch_key(item[1]) == key:
+                batch.append(item)
+            else:
+                self.pending.append(item)
+        return batch
+
+    async def run(self):
+        while True:
+            batch = [item for item in await self.collect_batch() if not item[0].done()]
+            if not batch:
+                continue
+            if len(batch) > 1:
+                print(f"Batching {len(batch)} requests")
+            try:
+                # This is the only worker, so GPU work is serialized; two concurrent
+                # pipeline calls on one GPU could OOM
+                results = await run_in_threadpool(generate_images_core, [params for _, params in batch])
+            except Exception as e:
+                for future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+batcher = BatchingServer()
+
+@app.post("/generate/image")
+async def generate_image_bytes(req: GenerateRequest, format: str = "png"):
+    try:
+        image_bytes, filename = await batcher.submit(req.prompt, req.height, req.width, req.steps, req.guidance_scale, req.seed, format)
+        return StreamingResponse(iter([image_bytes]), media_type=IMAGE_FORMATS[format], headers={"X-Filename": filename})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"Error generating image: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/generate")
-def generate_image(req: GenerateRequest):
+# Deprecated: use /generate/image, which returns the raw image instead of a base64 data URI
+@app.post("/generate", deprecated=True)
+async def generate_image(req: GenerateRequest, format: str = "png"):
     try:
-        img_str = generate_image_core(req.prompt, req.height, req.width, req.steps, req.guidance_scale, req.seed)
-        return {"image": f"data:image/png;base64,{img_str}"}
+        image_bytes, _ = await batcher.submit(req.prompt, req.height, req.width, req.steps, req.guidance_scale, req.seed, format)
+        return {"image": f"data:{IMAGE_FORMATS[format]};base64,{to_base64(image_bytes)}"}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -286,7 +726,8 @@ async def list_tools() -> list[types.Tool]:
                     "width": {"type": "integer", "default": 1920, "description": "Width of the image"},
                     "steps": {"type": "integer", "default": 8, "description": "Number of inference steps. 8 gives best results."},
                     "guidance_scale": {"type": "number", "default": 0.0, "description": "Guidance scale. 0.0 gives best results."},
-                    "seed": {"type": "integer", "default": -1, "description": "Random seed. Random is good"}
+                    "seed": {"type": "integer", "default": -1, "description": "Random seed. Random is good"},
+                    "format": {"type": "string", "enum": list(IMAGE_FORMATS), "default": "png", "description": "Image format. webp is lossless and smaller."}
                 }
             }
         )
@@ -301,14 +742,16 @@ async def call_tool(name: str, arguments: dict) -> list[types.ContentBlock]:
         steps = arguments.get("steps", 8)
         guidance_scale = arguments.get("guidance_scale", 0.0)
         seed = arguments.get("seed", -1)
+        image_format = arguments.get("format", "png")
         
         try:
-            img_base64 = await run_in_threadpool(generate_image_core, prompt, height, width, steps, guidance_scale, seed)
+            # MCP ImageContent requires base64
+            image_bytes, _ = await batcher.submit(prompt, height, width, steps, guidance_scale, seed, image_format)
             return [
                 types.ImageContent(
                     type="image",
-                    data=img_base64,
-                    mimeType="image/png",
+                    data=to_base64(image_bytes),
+                    mimeType=IMAGE_FORMATS[image_format],
                     annotations={
                         "audience": ["user"],
                         "priority": 1.0
@@ -326,7 +769,12 @@ def health():
 
 if __name__ == "__main__":
     import uvicorn
+    import importlib.util
+    # uvloop is not available on Windows
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
     try:
-        uvicorn.run(app, host="0.0.0.0", port=8000)
+        # One worker: the pipeline is a single GPU resource and can't be shared across processes
+        uvicorn.run(app, host="0.0.0.0", port=8000, loop=loop, http=http, workers=1, access_log=False)
     except KeyboardInterrupt:
         print("\nShutting down gracefully...")
@@ -61,7 +61,7 @@ function App() {
     if (!prompt) return
     setLoading(true)
     try {
-      const res = await fetch(apiUrl('/generate'), {
+      const res = await fetch(apiUrl('/generate/image'), {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ prompt, ...settings })
@@ -69,10 +69,12 @@ function App() {
       if (!res.ok) {
         throw new Error('Generation failed')
       }
-      const data = await res.json()
-      if (data.image) {
-        setImage(data.image)
-      }
+      const url = URL.createObjectURL(await res.blob())
+      setImage(prev => {
+        // Free the previous image's blob
+        if (prev) URL.revokeObjectURL(prev)
+        return url
+      })
     } catch (e) {
       console.error(e)
       alert('Error generating image. Check backend console.')